@@ -1,14 +1,22 @@
-from fastapi import FastAPI, HTTPException, Header, Request
-from pydantic import BaseModel
-from typing import List, Optional, Dict
+from fastapi import FastAPI, HTTPException, Header, Request, BackgroundTasks
+from fastapi.responses import ORJSONResponse
+from typing import List, Optional, Dict, Union
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+import ahocorasick
+import msgspec
+import orjson
+import httpx
+import redis.asyncio as redis
+import asyncio
+import itertools
 import os
 import re
 import random
-import requests
 import logging
 from dotenv import load_dotenv
 from datetime import datetime
+from collections import OrderedDict, deque
 import time
 
 load_dotenv()
@@ -22,37 +30,89 @@ GEMINI_KEY_2 = os.environ.get("GEMINI_API_KEY_2", "")
 GEMINI_KEY_3 = os.environ.get("GEMINI_API_KEY_3", "")
 
 ALL_GEMINI_KEYS = [k for k in [GEMINI_KEY_1, GEMINI_KEY_2, GEMINI_KEY_3] if k]
-current_key_index = 0
 
-if ALL_GEMINI_KEYS:
-    genai.configure(api_key=ALL_GEMINI_KEYS[0])
-
-model = genai.GenerativeModel('gemini-2.5-flash')
-
-app = FastAPI(title="Scam Honeypot API")
-
-sessions = {}
-conversation_start_times = {}  # NEW: Track duration
+MODELS: List[genai.GenerativeModel] = []  # One per key, built on startup
+
+
+def build_gemini_models() -> List[genai.GenerativeModel]:
+    models = []
+    for key in ALL_GEMINI_KEYS:
+        genai.configure(api_key=key)
+        gemini = genai.GenerativeModel('gemini-2.5-flash')
+        # The SDK creates clients lazily from whatever key is configured at
+        # first use; bind this key's client now so rotation is just an index
+        gemini._async_client = genai_client.get_default_generative_async_client()
+        models.append(gemini)
+    return models
+
+# Cap in-flight calls per key so bursts queue here instead of tripping 429s
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "60"))
+KEY_SEMAPHORES = [asyncio.Semaphore(GEMINI_CONCURRENCY) for _ in range(max(1, len(ALL_GEMINI_KEYS)))]
+
+# Keys take turns on every call; a key that returns 429 sits out for a while
+KEY_COOLDOWN_SECONDS = float(os.environ.get("GEMINI_KEY_COOLDOWN", "60"))
+key_cooldown_until: Dict[int, float] = {}
+key_turns = itertools.count()
+
+# A hung Gemini call is abandoned after this long and the fallback takes over
+DETECT_TIMEOUT = float(os.environ.get("GEMINI_DETECT_TIMEOUT", "3.0"))
+AGENT_TIMEOUT = float(os.environ.get("GEMINI_AGENT_TIMEOUT", "6.0"))
+
+app = FastAPI(title="Scam Honeypot API", default_response_class=ORJSONResponse)
+
+# In-memory sessions, least recently used first; idle ones are swept after
+# SESSION_TTL_SECONDS and the oldest dropped beyond MAX_SESSIONS
+sessions: "OrderedDict[str, Session]" = OrderedDict()
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "10000"))
+SESSION_SWEEP_INTERVAL = 60
+session_sweeper: Optional[asyncio.Task] = None
+
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None  # Created on startup, shared by callbacks
+
+# Sessions live in Redis when REDIS_URL is set, so several workers can share them.
+# SESSION_TTL_SECONDS is the idle timeout for either store.
+REDIS_URL = os.environ.get("REDIS_URL")
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "3600"))
+
+# Messages shown to Gemini as conversation context; Redis keeps no more
+CONTEXT_TURNS = 6
+redis_client: Optional[redis.Redis] = None
+
+# Gemini SCAM/SAFE verdicts keyed by normalized message text, oldest first,
+# stored as (is_scam, expires_at)
+AI_VERDICT_CACHE_SIZE = 10_000
+AI_VERDICT_TTL_SECONDS = 6 * 3600
+# Keys this short are mostly stripped numbers/punctuation and say nothing
+# about the message, so they aren't cached
+AI_VERDICT_MIN_KEY_LENGTH = 15
+ai_verdict_cache: "OrderedDict[str, tuple]" = OrderedDict()
 
 # ============= DATA MODELS =============
 
-class Message(BaseModel):
+class Message(msgspec.Struct):
     sender: str
     text: str
     timestamp: str
 
-class Metadata(BaseModel):
+class RequestMessage(msgspec.Struct):
+    """Message as sent by clients; timestamps may be ISO strings or epoch ms."""
+    sender: Optional[str] = "scammer"
+    text: str = ""
+    timestamp: Union[str, int, None] = None
+
+class Metadata(msgspec.Struct):
     channel: Optional[str] = "SMS"
     language: Optional[str] = "English"
     locale: Optional[str] = "IN"
 
-class HoneypotRequest(BaseModel):
-    sessionId: str
-    message: Message
-    conversationHistory: List[Message] = []
-    metadata: Optional[Metadata] = None
+class HoneypotRequest(msgspec.Struct):
+    sessionId: str = "unknown"
+    message: RequestMessage = msgspec.field(default_factory=RequestMessage)
+    # Accepted for compatibility but unused; Raw skips validating them
+    conversationHistory: msgspec.Raw = msgspec.Raw(b"[]")
+    metadata: msgspec.Raw = msgspec.Raw(b"null")  # Shaped like Metadata
 
-class HoneypotResponse(BaseModel):
+class HoneypotResponse(msgspec.Struct):
     status: str
     reply: str
 
@@ -96,7 +156,13 @@ SCAM_KEYWORDS = [
 
 # ============= IMPROVED FALLBACK WITH QUESTIONS =============
 
-FALLBACK_STAGE_1 = [
+# Share of agent replies served from the scripted stages without calling Gemini
+FALLBACK_PROBABILITY = float(os.environ.get("FALLBACK_PROB", "0.5"))
+
+# Answer the opening message straight from stage 1, so turn one never waits on Gemini
+INSTANT_FIRST_REPLY = os.environ.get("INSTANT_FIRST_REPLY", "1") == "1"
+
+FALLBACK_STAGE_1 = (
     "Oh my God! I'm so scared! Who are you? Can you give me your phone number?",
     "Please help me! Which department are you from? What's your employee ID?",
     "This is so stressful! Can I call you back? What's your number?",
@@ -104,9 +170,9 @@ FALLBACK_STAGE_1 = [
     "Arey bhai! What's happening? Who are you? What's your phone number?",
     "I never faced this! Are you from bank? What's your official number?",
     "My family account! How to fix? Who to contact? What's your number?",
-]
+)
 
-FALLBACK_STAGE_2 = [
+FALLBACK_STAGE_2 = (
     "You seem knowledgeable! Which account to use? What's your UPI ID?",
     "I trust you! What's exact process? Your supervisor's phone?",
     "Give me your direct number so I can call. What is it?",
@@ -114,9 +180,9 @@ FALLBACK_STAGE_2 = [
     "I want to do correctly. Your exact payment details? UPI? Account?",
     "How much exactly to send? What's your UPI ID? PhonePe or GPay?",
     "Safest way to pay? Your exact UPI ID or phone number?",
-]
+)
 
-FALLBACK_STAGE_3 = [
+FALLBACK_STAGE_3 = (
     "Ready to send now! What's your EXACT UPI ID? Tell me!",
     "Opening banking app. Your UPI ID? Should I use this number?",
     "Which account for transfer? Give exact details!",
@@ -124,23 +190,307 @@ FALLBACK_STAGE_3 = [
     "PhonePe or GPay? What's your UPI ID? Confirm phone?",
     "Doing immediately! Exact UPI ID and phone? Let me confirm!",
     "Give exact UPI and I send in 2 minutes! What is it?",
-]
+)
+
+# Own generator for the scripted replies, independent of the global random state
+fallback_rng = random.Random()
 
 def get_fallback_response(message_count: int) -> str:
     if message_count <= 1:
-        return random.choice(FALLBACK_STAGE_1)
+        return fallback_rng.choice(FALLBACK_STAGE_1)
     elif message_count <= 4:
-        return random.choice(FALLBACK_STAGE_2)
+        return fallback_rng.choice(FALLBACK_STAGE_2)
     else:
-        return random.choice(FALLBACK_STAGE_3)
+        return fallback_rng.choice(FALLBACK_STAGE_3)
+
+# ============= KEYWORD AUTOMATA =============
+
+def build_keyword_automaton(keywords: List[str]) -> ahocorasick.Automaton:
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        automaton.add_word(keyword.lower(), keyword)
+    automaton.make_automaton()
+    return automaton
+
+def find_keywords(automaton: ahocorasick.Automaton, text_lower: str) -> set:
+    """Distinct keywords present in already-lowercased text."""
+    return {kw for _, kw in automaton.iter(text_lower)}
+
+INTEL_KEYWORDS = ['urgent', 'verify', 'blocked', 'otp', 'transfer', 'prize', 'kyc']
+
+# Built once at import; each scan is a single pass over the text
+SCAM_KEYWORD_AC = build_keyword_automaton(SCAM_KEYWORDS)
+INTEL_KEYWORD_AC = build_keyword_automaton(INTEL_KEYWORDS)
+
+# ============= EXTRACTION PATTERNS =============
+
+# Identifiers are ASCII, so these run on UTF-8 bytes: ASCII-only \w/\d/\b
+# classes make the scan cheaper than unicode-aware str matching
+UPI_RE = re.compile(rb'\b[\w.\-]+@[\w.\-]+\b')
+PHONE_RE = re.compile(rb'\b[6-9]\d{9}\b')
+URL_RE = re.compile(rb'https?://[^\s<>"\']+')
+BANK_RE = re.compile(rb'\b\d{11,18}\b')
+
+def build_intel_regex(*named: str) -> re.Pattern:
+    patterns = {"url": URL_RE, "upi": UPI_RE, "bank": BANK_RE, "phone": PHONE_RE}
+    return re.compile(b"|".join(
+        b"(?P<" + name.encode() + b">" + patterns[name].pattern + b")" for name in named
+    ))
+
+# One alternation so a single scan finds every identifier type.
+# URLs go first so a link is captured whole; what's inside it is rescanned.
+COMBINED_RE = build_intel_regex("url", "upi", "bank", "phone")
+
+# Phones need a 10-digit run and accounts 11+; without one, drop those branches
+DIGIT_RUN_RE = re.compile(rb'\d{10,}')
+COMBINED_NO_BANK_RE = build_intel_regex("url", "upi", "phone")
+COMBINED_NO_DIGITS_RE = build_intel_regex("url", "upi")
+
+INTEL_BUCKETS = {
+    "url": "phishingLinks",
+    "upi": "upiIds",
+    "bank": "bankAccounts",
+    "phone": "phoneNumbers",
+}
+
+# Digits or links make even a very short message worth a Gemini check
+SHORT_MESSAGE_SIGNAL_RE = re.compile(r'\d|https?://|www\.')
+
+# Handles on these domains are email addresses, not UPI IDs
+FREE_MAIL_PROVIDERS = ('gmail', 'yahoo')
+
+CACHE_KEY_DIGITS_RE = re.compile(r'\d+')
+
+EMAIL_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+
+# ============= GEMINI MICRO-BATCHING =============
+
+def is_quota_error(e: Exception) -> bool:
+    error_str = str(e).lower()
+    return "quota" in error_str or "429" in error_str
+
+
+def pick_gemini_key() -> int:
+    now = time.monotonic()
+    for _ in range(len(MODELS)):
+        index = next(key_turns) % len(MODELS)
+        if key_cooldown_until.get(index, 0) <= now:
+            return index
+    # Every key is cooling down; use the one that recovers first
+    return min(range(len(MODELS)), key=lambda i: key_cooldown_until.get(i, 0))
+
+
+async def call_gemini(prompt: str, generation_config: Dict, timeout: float):
+    if not MODELS:
+        raise RuntimeError("No Gemini API keys configured")
+    index = pick_gemini_key()
+    try:
+        # The deadline covers waiting for a free slot on a busy key, too
+        async with asyncio.timeout(timeout):
+            async with KEY_SEMAPHORES[index]:
+                return await MODELS[index].generate_content_async(
+                    prompt,
+                    generation_config=generation_config,
+                    request_options={'timeout': timeout}
+                )
+    except TimeoutError:
+        raise TimeoutError(f"Gemini call timed out after {timeout:.1f}s") from None
+    except Exception as e:
+        if is_quota_error(e):
+            key_cooldown_until[index] = time.monotonic() + KEY_COOLDOWN_SECONDS
+            logger.info(f"Gemini key index {index} cooling down for {KEY_COOLDOWN_SECONDS:.0f}s")
+        raise
+
+
+class BatchedGemini:
+    """Coalesces prompts submitted within a short window into one Gemini call.
+
+    Callers await submit(prompt) and get back that prompt's reply text, or
+    None when Gemini filtered it. Batches of one are sent as-is; larger
+    batches ask for a JSON array with one answer per prompt.
+    """
+
+    def __init__(self, generation_config: Dict, timeout: float,
+                 max_batch: int = 8, max_wait_ms: int = 30):
+        self.generation_config = generation_config
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.in_flight = set()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        tasks = [t for t in [self.worker, *self.in_flight] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, prompt: str) -> Optional[str]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((prompt, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Dispatch without waiting so a slow batch doesn't hold up the next
+            task = asyncio.create_task(self._dispatch(batch))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    async def _dispatch(self, batch: List):
+        prompts = [prompt for prompt, _ in batch]
+        try:
+            if len(prompts) == 1:
+                replies = [await self._generate_one(prompts[0])]
+            else:
+                replies = await self._generate_many(prompts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), reply in zip(batch, replies):
+            if not future.done():
+                future.set_result(reply)
+
+    async def _generate_one(self, prompt: str) -> Optional[str]:
+        response = await self._call(prompt, self.generation_config)
+        if response.candidates:
+            candidate = response.candidates[0]
+            if hasattr(candidate, 'finish_reason') and candidate.finish_reason == 8:
+                logger.warning("Content filtered, using fallback")
+                return None
+        return response.text
+
+    async def _generate_many(self, prompts: List[str]) -> List[Optional[str]]:
+        # Prompts carry scammer text, so they go in JSON-encoded where it
+        # can't fake the start of another session's prompt
+        batch_prompt = f"""You will receive a JSON array of {len(prompts)} independent prompts. Answer each one on its own, following only its own instructions.
+
+Reply ONLY with a JSON array of {len(prompts)} strings. Element i is your answer to prompt i.
+
+{orjson.dumps(prompts).decode()}"""
+
+        config = dict(self.generation_config)
+        config['max_output_tokens'] = config.get('max_output_tokens', 150) * len(prompts)
+        config['response_mime_type'] = "application/json"
+
+        response = await self._call(batch_prompt, config)
+        replies = orjson.loads(response.text)
+        if not isinstance(replies, list) or len(replies) != len(prompts):
+            raise ValueError(f"Expected {len(prompts)} batched replies, got {replies!r:.100}")
+
+        logger.info(f"Batched Gemini call answered {len(prompts)} prompts")
+        return [reply if isinstance(reply, str) else None for reply in replies]
+
+    async def _call(self, prompt: str, generation_config: Dict):
+        # Retry once per batch, rather than once per waiting caller; each
+        # attempt lands on the next key that isn't cooling down
+        for attempt in range(max(1, len(MODELS))):
+            try:
+                return await call_gemini(prompt, generation_config, self.timeout)
+            except Exception as e:
+                logger.warning(f"Gemini error (attempt {attempt+1}): {e}")
+
+                if is_quota_error(e) and len(MODELS) > 1:
+                    last_error = e
+                    continue
+                raise
+        raise last_error
+
+
+class BatchedScamClassifier(BatchedGemini):
+    """Same coalescing, but submit() takes the raw message text and the
+    reply is "SCAM", "SAFE", or None when Gemini gave no usable verdict.
+    """
+
+    async def _generate_one(self, message_text: str) -> Optional[str]:
+        prompt = f"""Is this a scam message? Reply only "SCAM" or "SAFE".
+
+Message: "{message_text}"
+
+Answer:"""
+        response = await self._call(prompt, self.generation_config)
+        return "SCAM" if "SCAM" in response.text.strip().upper() else "SAFE"
+
+    async def _generate_many(self, messages: List[str]) -> List[Optional[str]]:
+        # Messages go in as a JSON array so scammer text can't fake extra entries
+        prompt = f"""Classify each message in the JSON array below as SCAM or SAFE.
+
+Reply ONLY with a JSON array of {len(messages)} strings, each "SCAM" or "SAFE". Element i is the verdict for message i.
+
+{orjson.dumps(messages).decode()}"""
+
+        config = dict(self.generation_config)
+        config['max_output_tokens'] = config.get('max_output_tokens', 10) * len(messages)
+        config['response_mime_type'] = "application/json"
+
+        response = await self._call(prompt, config)
+        verdicts = orjson.loads(response.text)
+        if not isinstance(verdicts, list) or len(verdicts) != len(messages):
+            raise ValueError(f"Expected {len(messages)} verdicts, got {verdicts!r:.100}")
+
+        logger.info(f"Batched scam check classified {len(messages)} messages")
+        return [
+            v.upper() if isinstance(v, str) and v.upper() in ("SCAM", "SAFE") else None
+            for v in verdicts
+        ]
+
+
+# Batches share one call's deadline, so keep them small enough to answer in it
+AGENT_BATCHER = BatchedGemini(
+    generation_config={'max_output_tokens': 150, 'temperature': 0.9},
+    timeout=AGENT_TIMEOUT,
+    max_batch=4
+)
+SCAM_BATCHER = BatchedScamClassifier(
+    generation_config={'max_output_tokens': 10},
+    timeout=DETECT_TIMEOUT,
+    max_wait_ms=20
+)
 
 # ============= HELPER FUNCTIONS (YOUR CODE + IMPROVEMENTS) =============
 
-def detect_scam(message_text: str, history: List[Message]) -> bool:
-    global current_key_index
+def utc_now_iso() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def normalize_timestamp(value: Union[str, int, None]) -> str:
+    """Client timestamps arrive as ISO strings or epoch milliseconds."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return datetime.fromtimestamp(value / 1000).isoformat() + "Z"
+    return utc_now_iso()
+
 
-    text_lower = message_text.lower()
-    keyword_count = sum(1 for keyword in SCAM_KEYWORDS if keyword in text_lower)
+def verdict_cache_key(text_lower: str) -> str:
+    # Drop digits so "send 5000" and "send 10000" share a verdict
+    return " ".join(CACHE_KEY_DIGITS_RE.sub("", text_lower).split())[:512]
+
+
+async def detect_scam(message_text: str, text_lower: Optional[str] = None) -> bool:
+    if text_lower is None:
+        text_lower = message_text.lower()
+    keyword_count = len(find_keywords(SCAM_KEYWORD_AC, text_lower))
 
     if keyword_count >= 2:
         logger.info(f"Scam detected by keywords ({keyword_count} found)")
@@ -150,20 +500,33 @@ def detect_scam(message_text: str, history: List[Message]) -> bool:
         logger.info("Scam detected by single keyword")
         return True
 
-    try:
-        prompt = f"""Is this a scam message? Reply only "SCAM" or "SAFE".
-
-Message: "{message_text}"
+    # Greetings and one-liners with no keyword, digit or link aren't worth an LLM call
+    if (len(text_lower) < 15 or len(text_lower.split()) < 4) \
+            and not SHORT_MESSAGE_SIGNAL_RE.search(text_lower):
+        logger.info("Short message without scam signals, treating as safe")
+        return False
 
-Answer:"""
+    # Scam campaigns resend the same template; reuse the earlier verdict
+    cache_key = verdict_cache_key(text_lower)
+    cacheable = len(cache_key) >= AI_VERDICT_MIN_KEY_LENGTH
+    cached = ai_verdict_cache.get(cache_key) if cacheable else None
+    if cached is not None and cached[1] > time.monotonic():
+        ai_verdict_cache.move_to_end(cache_key)
+        logger.info(f"AI scam detection (cached): {'SCAM' if cached[0] else 'SAFE'}")
+        return cached[0]
 
-        response = model.generate_content(
-            prompt,
-            generation_config={'max_output_tokens': 10}
-        )
-        result = response.text.strip().upper()
-        is_scam = "SCAM" in result
+    try:
+        result = await SCAM_BATCHER.submit(message_text)
+        if result is None:
+            raise ValueError("no verdict in batched reply")
+        is_scam = result == "SCAM"
         logger.info(f"AI scam detection: {'SCAM' if is_scam else 'SAFE'}")
+
+        if cacheable:
+            ai_verdict_cache[cache_key] = (is_scam, time.monotonic() + AI_VERDICT_TTL_SECONDS)
+            ai_verdict_cache.move_to_end(cache_key)
+            if len(ai_verdict_cache) > AI_VERDICT_CACHE_SIZE:
+                ai_verdict_cache.popitem(last=False)
         return is_scam
 
     except Exception as e:
@@ -171,26 +534,16 @@ Answer:"""
         return keyword_count >= 1
 
 
-def get_next_gemini_key() -> bool:
-    global current_key_index, model
-
-    if len(ALL_GEMINI_KEYS) <= 1:
-        return False
-
-    next_index = (current_key_index + 1) % len(ALL_GEMINI_KEYS)
-    if next_index == current_key_index:
-        return False
-
-    current_key_index = next_index
-    genai.configure(api_key=ALL_GEMINI_KEYS[current_key_index])
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    logger.info(f"Switched to Gemini key index {current_key_index}")
-    return True
+async def generate_agent_response(message_text: str, context_tail: deque,
+                                  message_count: int) -> str:
+    """message_count is the number of scammer messages so far, this one included."""
 
+    # Scammers expect a human delay; scripted replies cover many turns just as well
+    if (INSTANT_FIRST_REPLY and message_count <= 1) or fallback_rng.random() < FALLBACK_PROBABILITY:
+        logger.info(f"Scripted reply for message_count={message_count}")
+        return get_fallback_response(message_count)
 
-def generate_agent_response(message_text: str, history: List[Message]) -> str:
-    context = "\n".join([f"{msg.sender}: {msg.text}" for msg in history[-6:]])
-    message_count = len([m for m in history if m.sender == "scammer"])
+    context = "\n".join(context_tail)
 
     # IMPROVED: More aggressive questioning
     if message_count <= 1:
@@ -248,112 +601,107 @@ CRITICAL: MUST contain question mark (?) asking specific info!
 
 RESPOND (only your reply):"""
 
-    for attempt in range(len(ALL_GEMINI_KEYS) + 1):
-        try:
-            response = model.generate_content(
-                prompt,
-                generation_config={'max_output_tokens': 150, 'temperature': 0.9}
-            )
-
-            if response.candidates:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'finish_reason') and candidate.finish_reason == 8:
-                    logger.warning("Content filtered, using fallback")
-                    return get_fallback_response(message_count)
-
-            reply = response.text.strip().replace('"', '').replace("'", '').strip()
-
-            # Ensure has question
-            if '?' not in reply:
-                if message_count <= 1:
-                    reply += " What's your phone number?"
-                elif message_count <= 3:
-                    reply += " What's your exact UPI ID?"
-                else:
-                    reply += " Tell me UPI ID again?"
-
-            if len(reply.split()) < 5:
-                return get_fallback_response(message_count)
-
-            logger.info(f"AI response generated (key {current_key_index})")
-            return reply
-
-        except Exception as e:
-            error_str = str(e).lower()
-            logger.warning(f"Gemini error (attempt {attempt+1}): {e}")
-
-            if "quota" in error_str or "429" in error_str:
-                switched = get_next_gemini_key()
-                if not switched:
-                    break
-            else:
-                break
+    try:
+        reply = await AGENT_BATCHER.submit(prompt)
+    except Exception as e:
+        logger.warning(f"Gemini reply failed: {e}")
+        reply = None
 
-    logger.info(f"Using fallback for message_count={message_count}")
-    return get_fallback_response(message_count)
+    if reply is None:
+        logger.info(f"Using fallback for message_count={message_count}")
+        return get_fallback_response(message_count)
 
+    reply = reply.strip().replace('"', '').replace("'", '').strip()
 
-def extract_intelligence(full_conversation: str) -> Dict:
-    intel = {
-        "bankAccounts": [],
-        "upiIds": [],
-        "phishingLinks": [],
-        "phoneNumbers": [],
-        "emailAddresses": [],
-        "suspiciousKeywords": []
-    }
+    # Ensure has question
+    if '?' not in reply:
+        if message_count <= 1:
+            reply += " What's your phone number?"
+        elif message_count <= 3:
+            reply += " What's your exact UPI ID?"
+        else:
+            reply += " Tell me UPI ID again?"
 
-    # UPI IDs
-    upi_pattern = r'\b[\w.\-]+@[\w.\-]+\b'
-    upi_matches = re.findall(upi_pattern, full_conversation)
-    intel["upiIds"] = list(set([
-        u for u in upi_matches
-        if '@' in u and '@gmail' not in u.lower() and '@yahoo' not in u.lower()
-    ]))
+    if len(reply.split()) < 5:
+        return get_fallback_response(message_count)
 
-    # Phone numbers
-    phone_pattern = r'\b[6-9]\d{9}\b'
-    intel["phoneNumbers"] = list(set(re.findall(phone_pattern, full_conversation)))
+    logger.info("AI response generated")
+    return reply
 
-    # URLs
-    url_pattern = r'https?://[^\s<>"\']+'
-    intel["phishingLinks"] = list(set(re.findall(url_pattern, full_conversation)))
 
-    # Bank accounts
-    bank_pattern = r'\b\d{11,18}\b'
-    potential_accounts = re.findall(bank_pattern, full_conversation)
-    intel["bankAccounts"] = list(set([
-        acc for acc in potential_accounts if acc not in intel["phoneNumbers"]
-    ]))
+def new_intel() -> Dict[str, set]:
+    return {
+        "bankAccounts": set(),
+        "upiIds": set(),
+        "phishingLinks": set(),
+        "phoneNumbers": set(),
+        "emailAddresses": set(),
+        "suspiciousKeywords": set()
+    }
 
-    # Emails
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    emails = re.findall(email_pattern, full_conversation)
-    intel["emailAddresses"] = list(set([e for e in emails if e not in intel["upiIds"]]))
 
-    # Keywords
-    keywords = ['urgent', 'verify', 'blocked', 'otp', 'transfer', 'prize', 'kyc']
-    intel["suspiciousKeywords"] = list(set([
-        kw for kw in keywords if kw.lower() in full_conversation.lower()
-    ]))
+def ingest_message(text: str, intel: Dict[str, set], text_lower: Optional[str] = None):
+    """Add the identifiers and keywords found in one message to intel."""
+    conv_bytes = text.encode('utf-8', errors='ignore')
 
-    return intel
+    max_digit_run = max(map(len, DIGIT_RUN_RE.findall(conv_bytes)), default=0)
+    if max_digit_run >= 11:
+        intel_re = COMBINED_RE
+    elif max_digit_run == 10:
+        intel_re = COMBINED_NO_BANK_RE
+    else:
+        intel_re = COMBINED_NO_DIGITS_RE
+
+    # URLs, UPI IDs, bank accounts and phone numbers in a single pass
+    for m in intel_re.finditer(conv_bytes):
+        bucket = INTEL_BUCKETS[m.lastgroup]
+        value = m.group()
+        intel[bucket].add(value.decode())
+        # The alternation doesn't overlap matches, so handles and numbers inside
+        # a link (?u=abc@ybl, ?id=9123456789) or handle (9876543210@ybl) are
+        # picked out separately
+        if bucket == "phishingLinks":
+            intel["upiIds"].update(u.decode() for u in UPI_RE.findall(value))
+        if bucket in ("phishingLinks", "upiIds") and max_digit_run >= 10:
+            intel["phoneNumbers"].update(p.decode() for p in PHONE_RE.findall(value))
+            if max_digit_run >= 11:
+                intel["bankAccounts"].update(b.decode() for b in BANK_RE.findall(value))
+
+    intel["emailAddresses"].update(EMAIL_RE.findall(text))
+    if text_lower is None:
+        text_lower = text.lower()
+    intel["suspiciousKeywords"].update(find_keywords(INTEL_KEYWORD_AC, text_lower))
+
+
+def finalize_intelligence(intel: Dict[str, set]) -> Dict:
+    """Apply the cross-bucket filters and convert each bucket to a list."""
+    upi_ids = {
+        u for u in intel["upiIds"]
+        if not u.partition('@')[2].lower().startswith(FREE_MAIL_PROVIDERS)
+    }
+    return {
+        "bankAccounts": list(intel["bankAccounts"] - intel["phoneNumbers"]),
+        "upiIds": list(upi_ids),
+        "phishingLinks": list(intel["phishingLinks"]),
+        "phoneNumbers": list(intel["phoneNumbers"]),
+        "emailAddresses": list(intel["emailAddresses"] - upi_ids),
+        "suspiciousKeywords": list(intel["suspiciousKeywords"])
+    }
 
 
-def send_final_callback(session_id: str, session_data: Dict):
-    full_conv = "\n".join([f"{msg.sender}: {msg.text}" for msg in session_data['history']])
-    intel = extract_intelligence(full_conv)
+async def send_final_callback(session_id: str, session_data: "Session"):
+    intel = finalize_intelligence(session_data.intel)
+    total_messages = session_data.total_messages
 
-    start_time = conversation_start_times.get(session_id, time.time())
-    duration = int(time.time() - start_time)
+    duration = int(time.time() - session_data.start_time)
 
     payload = {
         "sessionId": session_id,
-        "scamDetected": session_data['scam_detected'],
-        "totalMessagesExchanged": len(session_data['history']),
+        "scamDetected": session_data.scam_detected,
+        "totalMessagesExchanged": total_messages,
         "engagementDurationSeconds": duration,
         "extractedIntelligence": intel,
-        "agentNotes": f"Scam detected. Engaged for {len(session_data['history'])} messages."
+        "agentNotes": f"Scam detected. Engaged for {total_messages} messages."
     }
 
     try:
@@ -362,7 +710,11 @@ def send_final_callback(session_id: str, session_data: Dict):
             logger.info("No callback URL, skipping")
             return False
 
-        response = requests.post(callback_url, json=payload, timeout=10)
+        response = await HTTP_CLIENT.post(
+            callback_url,
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"}
+        )
         logger.info(f"✅ Callback sent: {response.status_code}")
         return response.status_code == 200
 
@@ -370,6 +722,180 @@ def send_final_callback(session_id: str, session_data: Dict):
         logger.error(f"❌ Callback error: {e}")
         return False
 
+# ============= SESSION STORE =============
+
+class Session(msgspec.Struct):
+    """Per-conversation state. Structs are slotted, so there's no per-session dict."""
+    scam_detected: bool = False
+    message_count: int = 0
+    total_messages: int = 0
+    scammer_count: int = 0  # Drives the reply stage
+    callback_sent: bool = False
+    start_time: float = msgspec.field(default_factory=time.time)  # For engagementDurationSeconds
+    intel: Dict[str, set] = msgspec.field(default_factory=new_intel)  # Accumulated per message
+    # "sender: text" lines for the agent prompt, formatted once per message
+    context_tail: deque = msgspec.field(default_factory=lambda: deque(maxlen=CONTEXT_TURNS))
+    last_seen: float = msgspec.field(default_factory=time.monotonic)  # In-memory eviction only
+    # Counter values and "bucket:value" intel members already in Redis, so
+    # saves only send what changed
+    persisted_counts: Dict[str, int] = msgspec.field(default_factory=dict)
+    persisted_intel: set = msgspec.field(default_factory=set)
+
+
+def append_message(session_data: Session, message: Message):
+    session_data.context_tail.append(f"{message.sender}: {message.text}")
+
+
+def record_message(session_data: Session, message: Message, text_lower: Optional[str] = None):
+    append_message(session_data, message)
+    ingest_message(message.text, session_data.intel, text_lower)
+    session_data.total_messages += 1
+    if message.sender == "scammer":
+        session_data.scammer_count += 1
+
+
+def callback_snapshot(session_data: Session) -> Session:
+    # Background callbacks run after the response, when the next turn may
+    # already be adding to intel; hand them a copy with the sets frozen
+    return msgspec.structs.replace(session_data, intel={
+        bucket: frozenset(values) for bucket, values in session_data.intel.items()
+    })
+
+
+async def load_session(session_id: str) -> Session:
+    if redis_client is None:
+        session_data = sessions.get(session_id)
+        if session_data is None:
+            session_data = sessions[session_id] = Session()
+            if len(sessions) > MAX_SESSIONS:
+                sessions.popitem(last=False)
+        else:
+            sessions.move_to_end(session_id)
+        session_data.last_seen = time.monotonic()
+        return session_data
+
+    # session:{id} hash holds the counters, session:{id}:history the messages
+    # and session:{id}:intel a set of "bucket:value" members
+    key = f"session:{session_id}"
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(key)
+        pipe.lrange(f"{key}:history", -CONTEXT_TURNS, -1)  # Only the prompt tail is rebuilt
+        pipe.smembers(f"{key}:intel")
+        fields, history, intel = await pipe.execute()
+
+    session_data = Session()
+    if fields:
+        session_data.scam_detected = fields.get('scam_detected') == '1'
+        session_data.message_count = int(fields.get('message_count', 0))
+        session_data.total_messages = int(fields.get('total_messages', 0))
+        session_data.scammer_count = int(fields.get('scammer_count', 0))
+        session_data.callback_sent = fields.get('callback_sent') == '1'
+        session_data.start_time = float(fields.get('start_time', session_data.start_time))
+    session_data.persisted_counts = session_counts(session_data)
+    session_data.persisted_intel = set(intel)
+    for member in intel:
+        bucket, _, value = member.partition(':')
+        session_data.intel[bucket].add(value)
+    for stored in history:
+        append_message(session_data, msgspec.json.decode(stored, type=Message))
+    return session_data
+
+
+def evict_idle_sessions() -> int:
+    cutoff = time.monotonic() - SESSION_TTL_SECONDS
+    evicted = 0
+    # Oldest access first, so stop at the first session still in use
+    while sessions:
+        session_id, session_data = next(iter(sessions.items()))
+        if session_data.last_seen > cutoff:
+            break
+        del sessions[session_id]
+        evicted += 1
+    return evicted
+
+
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        evicted = evict_idle_sessions()
+        if evicted:
+            logger.info(f"Evicted {evicted} idle sessions")
+
+
+def session_counts(session_data: Session) -> Dict[str, int]:
+    return {
+        'message_count': session_data.message_count,
+        'total_messages': session_data.total_messages,
+        'scammer_count': session_data.scammer_count,
+    }
+
+
+async def save_session(session_id: str, session_data: Session, new_messages: List[Message]):
+    """Persist counters and append this turn's messages (no-op in memory)."""
+    if redis_client is None:
+        return
+
+    # Another worker may be mid-turn on the same session, so every write
+    # merges: counters go up by this turn's increments, flags only ever turn
+    # on, and intel is added to a set rather than overwritten
+    key = f"session:{session_id}"
+    counts = session_counts(session_data)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for field, value in counts.items():
+            increment = value - session_data.persisted_counts.get(field, 0)
+            if increment:
+                pipe.hincrby(key, field, increment)
+        flags = {f: 1 for f in ('scam_detected', 'callback_sent') if getattr(session_data, f)}
+        if flags:
+            pipe.hset(key, mapping=flags)
+        pipe.hsetnx(key, 'start_time', session_data.start_time)
+        intel = {f"{bucket}:{value}" for bucket, values in session_data.intel.items() for value in values}
+        added_intel = intel - session_data.persisted_intel
+        if added_intel:
+            pipe.sadd(f"{key}:intel", *added_intel)
+        if new_messages:
+            pipe.rpush(f"{key}:history", *[msgspec.json.encode(m) for m in new_messages])
+            pipe.ltrim(f"{key}:history", -CONTEXT_TURNS, -1)
+        for suffix in ("", ":history", ":intel"):
+            pipe.expire(f"{key}{suffix}", SESSION_TTL_SECONDS)
+        await pipe.execute()
+    session_data.persisted_counts = counts
+    session_data.persisted_intel = intel
+
+# ============= LIFECYCLE =============
+
+@app.on_event("startup")
+async def startup():
+    global HTTP_CLIENT, redis_client, session_sweeper
+    MODELS[:] = build_gemini_models()
+    # Repeat callbacks arrive minutes apart; keep the idle connection far longer
+    # than httpx's 5s default so they reuse it instead of redoing TCP + TLS.
+    # HTTP/2 lets concurrent callbacks share that one connection.
+    HTTP_CLIENT = httpx.AsyncClient(
+        timeout=10,
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=10, keepalive_expiry=300)
+    )
+    if REDIS_URL:
+        redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        logger.info("Using Redis session store")
+    else:
+        session_sweeper = asyncio.create_task(sweep_sessions())
+    AGENT_BATCHER.start()
+    SCAM_BATCHER.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await AGENT_BATCHER.stop()
+    await SCAM_BATCHER.stop()
+    if session_sweeper is not None:
+        session_sweeper.cancel()
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
 # ============= API ENDPOINTS =============
 
 @app.get("/")
@@ -394,73 +920,68 @@ def health_check():
         "status": "ok",
         "timestamp": datetime.utcnow().isoformat(),
         "active_sessions": len(sessions),
+        "session_store": "redis" if redis_client is not None else "memory",
         "gemini_keys": len(ALL_GEMINI_KEYS)
     }
 
 
 # NEW: /detect endpoint for evaluation!
 @app.post("/detect")
-async def detect_endpoint(request: Request):
+async def detect_endpoint(request: Request, background: BackgroundTasks):
     """Evaluation-compatible endpoint."""
     
     try:
-        data = await request.json()
-        
-        session_id = data.get("sessionId", "unknown")
-        message_obj = data.get("message", {})
-        message_text = message_obj.get("text", "")
+        data = msgspec.json.decode(await request.body(), type=HoneypotRequest)
         
-        if session_id not in conversation_start_times:
-            conversation_start_times[session_id] = time.time()
+        session_id = data.sessionId
+        message_text = data.message.text
         
-        if session_id not in sessions:
-            sessions[session_id] = {
-                'scam_detected': False,
-                'history': [],
-                'message_count': 0,
-                'callback_sent': False
-            }
-        
-        session_data = sessions[session_id]
+        session_data = await load_session(session_id)
         
         message = Message(
             sender="scammer",
             text=message_text,
-            timestamp=message_obj.get("timestamp", datetime.utcnow().isoformat() + "Z")
+            timestamp=normalize_timestamp(data.message.timestamp)
         )
+        # Shared by the intel scan and scam detection
+        text_lower = message_text.lower()
         
-        session_data['history'].append(message)
-        session_data['message_count'] += 1
-        msg_count = session_data['message_count']
+        record_message(session_data, message, text_lower)
+        session_data.message_count += 1
+        msg_count = session_data.message_count
         
         logger.info(f"Session {session_id[:8]}... | Msg #{msg_count} | {message_text[:50]}...")
         
         if msg_count == 1:
-            is_scam = detect_scam(message.text, [])
-            session_data['scam_detected'] = is_scam
+            is_scam = await detect_scam(message.text, text_lower)
+            session_data.scam_detected = is_scam
             logger.info(f"Scam detection: {is_scam}")
             
             if not is_scam:
+                await save_session(session_id, session_data, [message])
                 return {"status": "success", "reply": "Thank you for your message."}
         
-        agent_reply = generate_agent_response(message.text, session_data['history'])
+        agent_reply = await generate_agent_response(
+            message.text, session_data.context_tail, session_data.scammer_count
+        )
         
         agent_message = Message(
             sender="user",
             text=agent_reply,
-            timestamp=datetime.utcnow().isoformat() + "Z"
+            timestamp=utc_now_iso()
         )
-        session_data['history'].append(agent_message)
+        record_message(session_data, agent_message)
         
-        if session_data['scam_detected']:
-            if msg_count >= 3 and not session_data['callback_sent']:
-                send_final_callback(session_id, session_data)
-                session_data['callback_sent'] = True
+        if session_data.scam_detected:
+            if msg_count >= 3 and not session_data.callback_sent:
+                background.add_task(send_final_callback, session_id, callback_snapshot(session_data))
+                session_data.callback_sent = True
                 logger.info("Early callback at 3+ messages")
             elif msg_count >= 10:
-                send_final_callback(session_id, session_data)
+                background.add_task(send_final_callback, session_id, callback_snapshot(session_data))
                 logger.info(f"Repeat callback at {msg_count} messages")
         
+        await save_session(session_id, session_data, [message, agent_message])
         return {"status": "success", "reply": agent_reply}
         
     except Exception as e:
@@ -469,7 +990,7 @@ async def detect_endpoint(request: Request):
 
 
 @app.post("/honeypot")
-async def honeypot_endpoint(request: Request, x_api_key: str = Header(None)):
+async def honeypot_endpoint(request: Request, background: BackgroundTasks, x_api_key: str = Header(None)):
     """Original endpoint - kept for compatibility."""
 
     expected_key = os.environ.get("API_SECRET_KEY")
@@ -479,61 +1000,60 @@ async def honeypot_endpoint(request: Request, x_api_key: str = Header(None)):
         return {"status": "error", "reply": "Invalid API key"}
 
     try:
-        data = await request.json()
-
-        session_id = data.get('sessionId', 'unknown')
-        message_data = data.get('message', {})
-        message_text = message_data.get('text', '')
-        message_sender = message_data.get('sender', 'scammer')
+        data = msgspec.json.decode(await request.body(), type=HoneypotRequest)
 
-        message_timestamp = message_data.get('timestamp', datetime.utcnow().isoformat() + "Z")
-        if isinstance(message_timestamp, int):
-            message_timestamp = datetime.fromtimestamp(message_timestamp / 1000).isoformat() + "Z"
+        session_id = data.sessionId
+        message_text = data.message.text
+        message_sender = data.message.sender or "scammer"
 
-        message = Message(sender=message_sender, text=message_text, timestamp=message_timestamp)
+        message = Message(
+            sender=message_sender,
+            text=message_text,
+            timestamp=normalize_timestamp(data.message.timestamp)
+        )
 
     except Exception as e:
         logger.error(f"Parse error: {e}")
         return {"status": "error", "reply": f"Invalid format: {str(e)}"}
 
-    if session_id not in conversation_start_times:
-        conversation_start_times[session_id] = time.time()
-
-    if session_id not in sessions:
-        sessions[session_id] = {
-            'scam_detected': False,
-            'history': [],
-            'message_count': 0,
-            'callback_sent': False
-        }
+    # Redis may be unreachable; answer like /detect instead of a bare 500
+    try:
+        text_lower = message_text.lower()
+        session_data = await load_session(session_id)
+        record_message(session_data, message, text_lower)
+        session_data.message_count += 1
+        msg_count = session_data.message_count
 
-    session_data = sessions[session_id]
-    session_data['history'].append(message)
-    session_data['message_count'] += 1
-    msg_count = session_data['message_count']
+        logger.info(f"Session {session_id[:8]}... | Msg #{msg_count} | {message_text[:50]}...")
 
-    logger.info(f"Session {session_id[:8]}... | Msg #{msg_count} | {message_text[:50]}...")
+        if msg_count == 1:
+            is_scam = await detect_scam(message.text, text_lower)
+            session_data.scam_detected = is_scam
+            logger.info(f"Scam detection: {is_scam}")
 
-    if msg_count == 1:
-        is_scam = detect_scam(message.text, [])
-        session_data['scam_detected'] = is_scam
-        logger.info(f"Scam detection: {is_scam}")
+            if not is_scam:
+                await save_session(session_id, session_data, [message])
+                return {"status": "success", "reply": "Thank you."}
+        agent_reply = await generate_agent_response(
+            message.text, session_data.context_tail, session_data.scammer_count
+        )
 
-        if not is_scam:
-            return {"status": "success", "reply": "Thank you."}
-    agent_reply = generate_agent_response(message.text, session_data['history'])
+        agent_message = Message(sender="user", text=agent_reply, timestamp=utc_now_iso())
+        record_message(session_data, agent_message)
 
-    agent_message = Message(sender="user", text=agent_reply, timestamp=datetime.utcnow().isoformat() + "Z")
-    session_data['history'].append(agent_message)
+        if session_data.scam_detected:
+            if msg_count >= 3 and not session_data.callback_sent:
+                background.add_task(send_final_callback, session_id, callback_snapshot(session_data))
+                session_data.callback_sent = True
+            elif msg_count >= 8 and msg_count % 5 == 0:
+                background.add_task(send_final_callback, session_id, callback_snapshot(session_data))
 
-    if session_data['scam_detected']:
-        if msg_count >= 3 and not session_data['callback_sent']:
-            send_final_callback(session_id, session_data)
-            session_data['callback_sent'] = True
-        elif msg_count >= 8 and msg_count % 5 == 0:
-            send_final_callback(session_id, session_data)
+        await save_session(session_id, session_data, [message, agent_message])
+        return {"status": "success", "reply": agent_reply}
 
-    return {"status": "success", "reply": agent_reply}
+    except Exception as e:
+        logger.error(f"Error in /honeypot: {e}")
+        return {"status": "error", "reply": "Internal error"}
 
 
 if __name__ == "__main__":